@@ -37,7 +37,7 @@ oneq_ops = {1 : cirq.X,
 
 def sim_test(nqubits, depth, nreps, 
              insert_strategy=cirq.InsertStrategy.EARLIEST, 
-             verbose=False, sim_type=0):
+             verbose=False, sim_type=0, seed=None):
     """
     Cirq Simulator test for a circuit structure of layers consisting of
     random one qubit rotations and CNOTs between all qubits.
@@ -66,6 +66,9 @@ def sim_test(nqubits, depth, nreps,
             0 = cirq.google.XmonSimulator
             1 = cirq.Simulator
 
+        seed [type: int]
+            seed for the random number generator used to draw the circuit
+
     returns:
         (runtime of simulating the circuit) / nreps
     """
@@ -82,26 +85,22 @@ def sim_test(nqubits, depth, nreps,
     # random circuit
     # =========================================================================
     
-    def rot(qubit, params):
-        """
-        Helper function to return an arbitrary rotation of the form
-        R = Rz(params[2]) * Ry(params[1]) * Rx(params[0])
-        on the qubit.
-        """
-        rx = cirq.Rx(rads=params[0])
-        ry = cirq.Ry(rads=params[1])
-        rz = cirq.Rz(rads=params[2])
-        
-        yield (rx(qubit), ry(qubit), rz(qubit))
-
-    for _ in range(depth):
-        # append random single qubit rotations
-        for q in qbits:
-            circ.append(rot(q, 2 * np.pi * np.random.rand(3)),
-                        strategy=insert_strategy)
-
-        # get a random control qubit for cnots
-        ctrl = qbits[np.random.randint(len(qbits))]
+    # draw all rotation angles and control qubit indices up front
+    rng = np.random.default_rng(seed)
+    angles = 2 * np.pi * rng.random((depth, nqubits, 3))
+    ctrls = rng.integers(0, nqubits, depth)
+
+    for d in range(depth):
+        # append random single qubit rotations R = Rz * Ry * Rx
+        rot_ops = []
+        for q, (a, b, c) in zip(qbits, angles[d]):
+            rot_ops += [cirq.Rx(rads=a)(q),
+                        cirq.Ry(rads=b)(q),
+                        cirq.Rz(rads=c)(q)]
+        circ.append(rot_ops, strategy=insert_strategy)
+
+        # get the random control qubit for cnots
+        ctrl = qbits[ctrls[d]]
 
         # append layer of CNOTS
         circ.append([cirq.CNOT(ctrl, targ) for targ in qbits if targ != ctrl],
@@ -124,7 +123,7 @@ def sim_test(nqubits, depth, nreps,
     return (time.time() - start) / nreps
 
 def random_circuit(num_qubits, depth, 
-                   oneq_ops_dict=oneq_ops):
+                   oneq_ops_dict=oneq_ops, seed=None):
     """Returns a circuit with one qubit gates selected at random from
     'oneq_ops_dict' for a specified number of qubits 'num_qubits'
     and depth 'depth'.
@@ -140,6 +139,9 @@ def random_circuit(num_qubits, depth,
             dictionary of one qubit operations with (key, value) pairs that
             consist of (integer key, gate)
 
+        seed [type: int]
+            seed for the random number generator used to select the gates
+
     Returns:
         A cirq.Circuit with 'num_qubits' qubits and 'depth' total single
         qubit gates selected at random from 'oneq_ops_dict'.
@@ -148,29 +150,21 @@ def random_circuit(num_qubits, depth,
     circ = cirq.Circuit()
     qbits = [cirq.LineQubit(x) for x in range(num_qubits)]
 
-    # loop over the depth
-    for _ in range(depth):
-        # select random integers corresponding to gates to append to circuit
-        op_keys = np.random.randint(1, len(oneq_ops) + 1, num_qubits)
+    # array of the gates indexed by their integer keys
+    gates = np.empty(max(oneq_ops_dict) + 1, dtype=object)
+    for key, gate in oneq_ops_dict.items():
+        gates[key] = gate
 
+    # select random integers corresponding to gates for the whole circuit
+    rng = np.random.default_rng(seed)
+    op_keys = rng.choice(list(oneq_ops_dict), size=(depth, num_qubits))
+
+    # loop over the depth
+    for d in range(depth):
         # append the gates to the circuit
         circ.append(
-            [oneq_ops[key](qbits[q]) for (q, key) in enumerate(op_keys)],
+            [gate(q) for (gate, q) in zip(gates[op_keys[d]], qbits)],
             strategy=cirq.InsertStrategy.EARLIEST
             )
 
     return circ, qbits
-
-def rot(qubit, params):
-        """Helper function that returns an arbitrary rotation of the form
-        R = Rz(params[2]) * Ry(params[1]) * Rx(params[0])
-        on the qubit, e.g. R |qubit>.
-
-        Note that order is reversed when put into the circuit. The circuit is:
-        |qubit>---Rx(params[0])---Ry(params[1])---Rz(params[2])---
-        """
-        rx = cirq.Rz(params[0])
-        ry = cirq.Rx(params[1])
-        rz = cirq.Rz(params[2])
-
-        yield (rx(qubit), ry(qubit), rz(qubit))
\ No newline at end of file
@@ -16,12 +16,8 @@ outfname="timing_$today.txt"
 # main testing
 # ============
 
-for n in 10 12 14 16 18 20 22 24
-do
-    echo "n=$n"
-    for depth in 20 40 60 80 100
-    do
-	echo "depth=$depth"
-        python sim_test.py $n $depth 1 1 >> timing/$outfname
-    done
-done
+# sweeps over n = 10, 12, ..., 24 qubits and depths 20, 40, ..., 100 with
+# 1 shot on cirq.Simulator, one line per (n, depth) in the same order as
+# looping over n and then depth; a single worker process keeps the timings
+# free of contention for cores and memory bandwidth
+python sim_test.py sweep 1 1 1 >> timing/$outfname
@@ -4,13 +4,23 @@
 # imports
 # =============================================================================
 
+import functools
+import os
 import sys
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 
 import cirq
 
+# Numba is optional, without it the closed form of the rotation unitaries is
+# evaluated by plain NumPy instead of compiled code
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 # =============================================================================
 # constants
 # =============================================================================
@@ -23,13 +33,258 @@ oneq_ops = {1 : cirq.X,
             5 : cirq.X ** 0.5,
             6 : cirq.T}
 
+# unitaries used when fusing rotations into the CNOTs
+IDENTITY = np.eye(2)
+HADAMARD = cirq.unitary(cirq.H)
+CNOT_UNITARY = cirq.unitary(cirq.CNOT)
+
+# with fuse = 1 the rotation angles are rounded to integer multiples of
+# ANGLE_STEP, so the fused rotation gates can be cached by their angles
+ANGLE_STEPS = 2 ** 16
+ANGLE_STEP = 2 * np.pi / ANGLE_STEPS
+
+# dtype of the state vector: single precision halves the memory traffic of
+# each gate, at the cost of errors of order 1e-7 in the amplitudes, which is
+# well below what matters for timing random circuits
+STATE_DTYPE = np.complex64
+
+# simulator constructors for each sim_type, called lazily so that optional
+# backends are only imported when used; sim_type = 0 was
+# cirq.google.XmonSimulator, which only exists in Cirq versions too old for
+# the circuits built here
+SIMULATORS = {1 : lambda: cirq.Simulator(dtype=STATE_DTYPE),
+              2 : lambda: qsim_simulator({'t' : os.cpu_count(), 'f' : 4}),
+              3 : lambda: qsim_gpu_simulator()}
+
+# simulators constructed so far, keyed by sim_type
+_simulators = {}
+
+# numbers of qubits and depths used by 'python sim_test.py sweep'
+SWEEP_QUBITS = range(10, 24 + 1, 2)
+SWEEP_DEPTHS = range(20, 100 + 1, 20)
+
+# =============================================================================
+# classes
+# =============================================================================
+
+class CZStarGate(cirq.Gate):
+    """Product of CZ gates from the first qubit the gate acts on (the control)
+    to each of the remaining qubits (the targets).
+
+    All of the CZs are diagonal and commute, so the whole star is applied as a
+    single elementwise multiplication of the state by +/-1 phases, i.e. one
+    pass over the state vector instead of one per CZ.
+    """
+    def __init__(self, num_qubits):
+        self._num_qubits = num_qubits
+
+    def _num_qubits_(self):
+        return self._num_qubits
+
+    def _apply_unitary_(self, args):
+        ndim = args.target_tensor.ndim
+
+        def bit(axis):
+            """Values of the qubit on 'axis', broadcastable to the state."""
+            shape = [1] * ndim
+            shape[axis] = 2
+            return np.arange(2, dtype=np.int8).reshape(shape)
+
+        # the phase is -1 where the control is 1 and the target parity is odd
+        parity = np.zeros((1,) * ndim, dtype=np.int8)
+        for axis in args.axes[1:]:
+            parity = parity ^ bit(axis)
+        args.target_tensor *= 1 - 2 * (bit(args.axes[0]) & parity)
+        return args.target_tensor
+
+    def _circuit_diagram_info_(self, args):
+        return ('@',) * self._num_qubits
+
 # =============================================================================
 # functions
 # =============================================================================
 
+def _rzyx_entries(a, b, c):
+    """Returns the entries (u00, u01, u10, u11) of the unitary of the
+    rotation R = Rz(c) * Ry(b) * Rx(a) in closed form, elementwise if the
+    angles are arrays.
+    """
+    ca, sa = np.cos(a / 2), np.sin(a / 2)
+    cb, sb = np.cos(b / 2), np.sin(b / 2)
+    em, ep = np.exp(-0.5j * c), np.exp(0.5j * c)
+
+    return (em * (cb * ca + 1j * sb * sa),
+            -em * (sb * ca + 1j * cb * sa),
+            ep * (sb * ca - 1j * cb * sa),
+            ep * (cb * ca - 1j * sb * sa))
+
+def rzyx(a, b, c):
+    """Returns the unitary of the arbitrary single qubit rotation
+    R = Rz(c) * Ry(b) * Rx(a)
+    in closed form.
+    """
+    u = np.empty((2, 2), dtype=np.complex128)
+    u[0, 0], u[0, 1], u[1, 0], u[1, 1] = _rzyx_entries(a, b, c)
+    return u
+
+def rotation_unitaries(ax, ay, az):
+    """Returns the unitaries of arbitrary single qubit rotations of the form
+    R = Rz(az[d, q]) * Ry(ay[d, q]) * Rx(ax[d, q])
+    for every layer d and qubit q.
+
+    input:
+        ax, ay, az [type: numpy.ndarray]
+            contiguous arrays of shape (depth, nqubits) of rotation angles
+            about the x, y and z axes
+
+    returns:
+        numpy.ndarray of shape (depth, nqubits, 2, 2) holding the unitaries
+    """
+    unitaries = np.empty(ax.shape + (2, 2), dtype=np.complex128)
+    (unitaries[..., 0, 0], unitaries[..., 0, 1],
+     unitaries[..., 1, 0], unitaries[..., 1, 1]) = _rzyx_entries(ax, ay, az)
+    return unitaries
+
+# compile the closed form with Numba when it is available
+if njit is not None:
+    _rzyx_entries = njit(cache=True)(_rzyx_entries)
+
+def simulate_layers(unitaries, ctrls, dtype=STATE_DTYPE):
+    """Simulates the circuit of sim_test directly with NumPy, without any of
+    the per operation overhead of Cirq, and returns the final state vector.
+
+    Qubit q is axis q of the state reshaped to (2,) * nqubits, which matches
+    the ordering of cirq.LineQubit(q) in Cirq's state vectors.
+
+    input:
+        unitaries [type: numpy.ndarray]
+            array of shape (depth, nqubits, 2, 2) of the rotation on each
+            qubit in each layer, as returned by rotation_unitaries
+
+        ctrls [type: numpy.ndarray]
+            array of shape (depth,) of the control qubit of each layer
+
+        dtype [type: numpy.dtype,
+               default = STATE_DTYPE]
+            dtype of the state vector
+
+    returns:
+        numpy.ndarray of shape (2 ** nqubits,) holding the final state
+    """
+    depth, nqubits = unitaries.shape[:2]
+    unitaries = unitaries.astype(dtype)
+
+    state = np.zeros(2 ** nqubits, dtype=dtype)
+    state[0] = 1
+    state = state.reshape((2,) * nqubits)
+
+    for d in range(depth):
+        # single qubit rotations
+        for q in range(nqubits):
+            state = np.tensordot(unitaries[d, q], state, axes=([1], [q]))
+            state = np.moveaxis(state, 0, q)
+
+        # the CNOTs from the control flip every target qubit where the
+        # control is 1, i.e. flip all other axes of that half of the state
+        half = [slice(None)] * nqubits
+        half[ctrls[d]] = 1
+        half = tuple(half)
+        state[half] = np.flip(state[half])
+
+    return state.reshape(-1)
+
+def sample_bits(state, nreps, rng):
+    """Returns 'nreps' samples of measuring every qubit of 'state' as an
+    array of shape (nreps, nqubits) of bits, with qubit 0 first.
+    """
+    nqubits = state.size.bit_length() - 1
+    probs = np.abs(state) ** 2
+    probs = probs.astype(np.float64)
+    probs /= probs.sum()
+
+    idx = rng.choice(probs.size, size=nreps, p=probs)
+    shifts = np.arange(nqubits - 1, -1, -1)
+    return ((idx[:, None] >> shifts) & 1).astype(np.uint8)
+
+def _strip_measurements(circ, qubits):
+    """Splits 'circ', whose measurements must all be terminal, into the
+    circuit without its measurements and a list of (key, columns) pairs giving
+    the positions in 'qubits' of the qubits measured under each key.
+    """
+    if not circ.are_all_measurements_terminal():
+        raise ValueError("All measurements must be terminal.")
+
+    measurements = list(circ.findall_operations(cirq.is_measurement))
+    stripped = circ.copy()
+    stripped.batch_remove(measurements)
+
+    index = {q : i for i, q in enumerate(qubits)}
+    keys = [(cirq.measurement_key_name(op), [index[q] for q in op.qubits])
+            for _, op in measurements]
+    return stripped, keys
+
+def _run_fast(simulator, stripped, keys, qubits, nreps, rng):
+    """Stand-in for simulator.run(circ, repetitions=nreps) for circuits whose
+    measurements are all terminal: 'stripped' and 'keys' are returned by
+    _strip_measurements(circ, qubits), the stripped circuit is simulated once
+    and every repetition is sampled from the final state vector.
+
+    returns:
+        dictionary of measurement key to array of shape (nreps, number of
+        measured qubits) of bits, as in the measurements of a cirq.Result
+    """
+    state = simulator.simulate(stripped, qubit_order=qubits).final_state_vector
+    bits = sample_bits(state, nreps, rng)
+    return {key : bits[:, columns] for key, columns in keys}
+
+@functools.lru_cache(maxsize=65536)
+def rotation_gate(ai, bi, ci):
+    """Returns the rotation Rz(ci * ANGLE_STEP) * Ry(bi * ANGLE_STEP) *
+    Rx(ai * ANGLE_STEP) as a cirq.MatrixGate, cached so that repeated angles
+    reuse the same gate instead of recomputing its unitary.
+    """
+    return cirq.MatrixGate(rzyx(ai * ANGLE_STEP,
+                                bi * ANGLE_STEP,
+                                ci * ANGLE_STEP))
+
+def qsim_simulator(qsim_options):
+    """Returns a qsimcirq.QSimSimulator with the given 'qsim_options'.
+
+    qsimcirq is imported here rather than at the top of the module since it
+    is only needed when running on qsim.
+    """
+    import qsimcirq
+    return qsimcirq.QSimSimulator(qsim_options=qsim_options)
+
+def qsim_gpu_simulator():
+    """Returns a qsimcirq.QSimSimulator running on the GPU, falling back to
+    qsim on the CPU (as for sim_type = 2) on machines without CUDA support.
+    """
+    try:
+        return qsim_simulator({'g' : True, 'gpu_mode' : 1})
+    except ValueError:
+        print('GPU not available, falling back to qsim on the CPU',
+              file=sys.stderr)
+        return SIMULATORS[2]()
+
+def get_simulator(sim_type):
+    """Returns the simulator for 'sim_type' (see SIMULATORS), constructing it
+    on first use and reusing it for all later calls.
+    """
+    if sim_type == 0:
+        raise ValueError("sim_type = 0 (cirq.google.XmonSimulator) is no "
+                         "longer supported, use sim_type = 1 instead.")
+    if sim_type not in SIMULATORS:
+        raise ValueError("Unknown sim_type {}.".format(sim_type))
+
+    if sim_type not in _simulators:
+        _simulators[sim_type] = SIMULATORS[sim_type]()
+    return _simulators[sim_type]
+
 def sim_test(nqubits, depth, nreps, 
-             insert_strategy=cirq.InsertStrategy.EARLIEST, 
-             verbose=False, sim_type=0):
+             insert_strategy=cirq.InsertStrategy.NEW_THEN_INLINE, 
+             verbose=False, sim_type=1, fuse=1, seed=None,
+             merge_moments=False):
     """Cirq Simulator test for a circuit structure of layers consisting of
     random one qubit rotations and CNOTs between all qubits.
     
@@ -41,29 +296,91 @@ def sim_test(nqubits, depth, nreps,
             number of layers (described above) in the circuit
             
         nreps [type: int]
-            number of times to run the circuit as per the keyword argument
-            'repetitions' in the method cirq.google.XmonSimulator.run.
+            number of measurement samples drawn from the final state of the
+            circuit, which is simulated only once
             
         insert_strategy [type: cirq.InsertStrategy,
-                         default = cirq.InsertStrategy.EARLIEST]
-            insert strategy for new gates in the circuit
+                         default = cirq.InsertStrategy.NEW_THEN_INLINE]
+            insert strategy for new gates in the circuit; NEW_THEN_INLINE
+            only looks at the last moment, whereas EARLIEST scans back over
+            all moments for every gate appended
         
         verbose [type: bool,
                  default = False]
             flag for verbose output to console (prints out circuit)
 
-        sim_type [type: bool]
+        sim_type [type: int,
+                  default = 1]
             what simulator to use in the timing analysis
-            0 = cirq.google.XmonSimulator
-            1 = cirq.Simulator
+            1 = cirq.Simulator with a STATE_DTYPE state vector
+            2 = qsimcirq.QSimSimulator on all cores, fusing gates into
+                blocks of up to four qubits
+            3 = qsimcirq.QSimSimulator on the GPU, or as for 2 if no GPU
+                is available
+            4 = simulate_layers, a NumPy simulation of the same circuit
+                that bypasses Cirq (fuse, insert_strategy, merge_moments
+                and verbose have no effect)
+
+        fuse [type: int,
+              default = 1]
+            how much of each layer to fuse into cirq.MatrixGates
+            0 = no fusion, separate Rx, Ry, Rz and CNOT gates
+            1 = the three rotations on each qubit fused into one gate
+            2 = the fused rotations further folded into the CNOTs, so each
+                layer is one two qubit gate per target qubit; this halves
+                the number of gates but cirq.Simulator applies a two qubit
+                MatrixGate through a general einsum rather than its cheap
+                CNOT kernel, so it only pays off on simulators that handle
+                arbitrary two qubit gates well (e.g. qsim)
+            3 = the fused rotations followed by the CNOTs written as
+                H * CZ * H on the targets, with the Hs folded into the
+                rotations before and after them and all CZs applied as one
+                CZStarGate, i.e. nqubits + 1 gates per layer
+                (only for sim_type = 1, since qsim would need the full
+                2 ** nqubits by 2 ** nqubits unitary of the gate)
+
+        seed [type: int,
+              default = None]
+            seed for the random number generator used to draw the circuit
+            and the measurement samples
+
+        merge_moments [type: bool,
+                       default = False]
+            flag for merging adjacent moments of single qubit gates into
+            one moment of cirq.PhasedXZGates before simulating
 
     returns:
         (runtime of simulating the circuit) / nreps
     """
+    if fuse == 3 and sim_type not in (1, 4):
+        raise ValueError("fuse = 3 is only supported for sim_type = 1.")
+
+    # draw all rotation angles and control qubit indices up front
+    rng = np.random.default_rng(seed)
+    angles = 2 * np.pi * rng.random((3, depth, nqubits))
+    ax, ay, az = angles
+    if fuse:
+        # only the single qubit gates built by rotation_gate use these
+        angle_keys = np.rint(angles / ANGLE_STEP).astype(int) % ANGLE_STEPS
+    ctrls = rng.integers(0, nqubits, depth)
+    if fuse >= 2 or sim_type == 4:
+        unitaries = rotation_unitaries(ax, ay, az)
+
+    # =========================================================================
+    # NumPy simulation of the circuit, kept separate from Cirq
+    # =========================================================================
+
+    if sim_type == 4:
+        # untimed warm-up run so caches and buffers are hot before timing
+        simulate_layers(unitaries, ctrls)
+
+        start = time.perf_counter()
+        state = simulate_layers(unitaries, ctrls)
+        sample_bits(state, nreps, rng)
+        return (time.perf_counter() - start) / nreps
+
     # get a simulator
-    simulator = cirq.google.XmonSimulator()
-    if sim_type == 1:
-        simulator = cirq.Simulator()
+    simulator = get_simulator(sim_type)
     
     # get some qubits and a circuit
     qbits = [cirq.LineQubit(x) for x in range(nqubits)]
@@ -73,33 +390,67 @@ def sim_test(nqubits, depth, nreps,
     # random circuit
     # =========================================================================
     
-    def rot(qubit, params):
-        """Helper function to return an arbitrary rotation of the form
-        R = Rz(params[2]) * Ry(params[1]) * Rx(params[0])
-        on the qubit.
-        """
-        rx = cirq.Rx(rads=params[0])
-        ry = cirq.Ry(rads=params[1])
-        rz = cirq.Rz(rads=params[2])
-        
-        yield (rx(qubit), ry(qubit), rz(qubit))
-
-    for _ in range(depth):
-        # append random single qubit rotations
-        for q in qbits:
-            circ.append(rot(q, 2 * np.pi * np.random.rand(3)),
-                        strategy=insert_strategy)
-
-        # get a random control qubit for cnots
-        ctrl = qbits[np.random.randint(len(qbits))]
-
-        # append layer of CNOTS
-        circ.append([cirq.CNOT(ctrl, targ) for targ in qbits if targ != ctrl],
-                     strategy=insert_strategy)
-    # measurements     
-    for q in qbits:
-        circ.append(cirq.measure(q),
-                    strategy=cirq.InsertStrategy.INLINE)
+    # qubits still owed the trailing H of the previous layer when fuse = 3
+    trailing_h = []
+
+    for d in range(depth):
+        # random control qubit for the layer of CNOTs to all other qubits
+        ictrl = ctrls[d]
+        ctrl = qbits[ictrl]
+        targs = [t for t in range(nqubits) if t != ictrl]
+
+        if fuse == 2 and targs:
+            # fold the rotation on each target into its CNOT, and the rotation
+            # on the control into the first CNOT only
+            first = CNOT_UNITARY @ np.kron(unitaries[d, ictrl],
+                                           unitaries[d, targs[0]])
+            layer_ops = [cirq.MatrixGate(first).on(ctrl, qbits[targs[0]])]
+            layer_ops += [
+                cirq.MatrixGate(
+                    CNOT_UNITARY @ np.kron(IDENTITY, unitaries[d, t])
+                ).on(ctrl, qbits[t])
+                for t in targs[1:]
+                ]
+        elif fuse == 3 and targs:
+            # CNOT(c, t) = H(t) CZ(c, t) H(t), with the leading Hs on the
+            # targets folded into their rotations and the trailing Hs of the
+            # previous layer folded into this layer's rotations
+            u = unitaries[d].copy()
+            u[trailing_h] = u[trailing_h] @ HADAMARD
+            u[targs] = HADAMARD @ u[targs]
+            layer_ops = [cirq.MatrixGate(m).on(q) for q, m in zip(qbits, u)]
+            layer_ops.append(
+                CZStarGate(nqubits).on(ctrl, *[qbits[t] for t in targs])
+                )
+            trailing_h = targs
+        else:
+            # random single qubit rotations R = Rz * Ry * Rx on each qubit
+            if fuse:
+                layer_ops = [rotation_gate(*keys).on(q) for q, keys
+                             in zip(qbits, angle_keys[:, d].T.tolist())]
+            else:
+                # grouped by gate so each rotation type fills a single moment
+                layer_ops = [cirq.rx(a).on(q) for q, a in zip(qbits, ax[d])]
+                layer_ops += [cirq.ry(b).on(q) for q, b in zip(qbits, ay[d])]
+                layer_ops += [cirq.rz(c).on(q) for q, c in zip(qbits, az[d])]
+
+            # layer of CNOTs
+            layer_ops += [cirq.CNOT(ctrl, qbits[t]) for t in targs]
+
+        # append the whole layer at once
+        circ.append(layer_ops, strategy=insert_strategy)
+
+    # trailing Hs of the last layer, which have no later rotations to join
+    circ.append([cirq.H(qbits[t]) for t in trailing_h],
+                strategy=insert_strategy)
+
+    # compress runs of single qubit moments left by the insert strategy
+    if merge_moments:
+        circ = cirq.merge_single_qubit_moments_to_phxz(circ)
+
+    # measure all qubits at once under a single key
+    circ.append(cirq.measure(*qbits, key='m'),
+                strategy=cirq.InsertStrategy.INLINE)
     
     # verbose options
     if verbose:
@@ -109,9 +460,47 @@ def sim_test(nqubits, depth, nreps,
     # do the circuit execution and time it
     # =========================================================================
     
-    start = time.time()
-    simulator.run(circ, repetitions=nreps)
-    return (time.time() - start) / nreps
+    # strip the terminal measurements once, outside of the timed region
+    stripped, keys = _strip_measurements(circ, qbits)
+
+    # untimed warm-up run so caches and buffers are hot before timing
+    _run_fast(simulator, stripped, keys, qbits, 1, rng)
+
+    start = time.perf_counter()
+    _run_fast(simulator, stripped, keys, qbits, nreps, rng)
+    return (time.perf_counter() - start) / nreps
+
+def _run_one(config):
+    """Runs sim_test for a single (nqubits, depth, nreps, sim_type) config and
+    returns (nqubits, depth, nreps, time).
+    """
+    nqubits, depth, nreps, sim_type = config
+    return nqubits, depth, nreps, sim_test(nqubits, depth, nreps,
+                                           sim_type=sim_type)
+
+def sweep(configs, max_workers=None):
+    """Runs sim_test for every (nqubits, depth, nreps, sim_type) config in
+    'configs' across a pool of processes, so the cost of importing Cirq is
+    paid once per worker rather than once per config.
+
+    Note that the workers compete for memory bandwidth and cores, so for large
+    numbers of qubits or the multithreaded qsim simulators 'max_workers'
+    should be kept small (or 1) to get representative timings.
+
+    input:
+        configs [type: iterable]
+            (nqubits, depth, nreps, sim_type) tuples to time
+
+        max_workers [type: int,
+                     default = None]
+            number of worker processes, defaults to the number of cores
+
+    yields:
+        (nqubits, depth, nreps, time) in the same order as 'configs', each as
+        soon as it and all configs before it have finished
+    """
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        yield from executor.map(_run_one, configs)
 
 # =============================================================================
 # main 
@@ -119,6 +508,29 @@ def sim_test(nqubits, depth, nreps,
 
 def main():
     """Main function for the script."""
+    # sweep over all numbers of qubits and depths
+    if len(sys.argv) >= 2 and sys.argv[1] == 'sweep':
+        if len(sys.argv) >= 3:
+            shots = int(sys.argv[2])
+        else:
+            shots = 1
+        if len(sys.argv) >= 4:
+            sim = int(sys.argv[3])
+        else:
+            sim = 1
+        if len(sys.argv) >= 5:
+            workers = int(sys.argv[4])
+        else:
+            workers = 1
+
+        configs = [(nqubits, depth, shots, sim)
+                   for nqubits in SWEEP_QUBITS for depth in SWEEP_DEPTHS]
+        # print each result as it arrives so that a crash part way through
+        # the sweep keeps the timings written so far
+        for result in sweep(configs, max_workers=workers):
+            print(*result, flush=True)
+        return
+
     # grab user input    
     if len(sys.argv) >= 2:
         nqubits = int(sys.argv[1])
@@ -142,7 +554,7 @@ def main():
     if len(sys.argv) >= 6:
         sim = int(sys.argv[5])
     else:
-        sim = 0
+        sim = 1
 
     # run the simulator test and print the results
     print(nqubits, depth, 